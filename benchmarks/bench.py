@@ -0,0 +1,231 @@
+"""
+Microbenchmarks of the CPU bound path helpers.
+
+Run from the package root with a plain python interpreter:
+
+    python benchmarks/bench.py [--full] [--save] [--tolerance 0.3]
+
+The `sublime` module is replaced by a stub, so no Sublime Text is required.
+Results are reported as processed paths per second and peak memory and are
+compared against `benchmarks/baseline.json`. The script exits with status 1
+if any benchmark is slower or needs more memory than the baseline by more
+than `--tolerance`.
+Baseline figures depend on the machine, use `--save` to record new ones.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from fnmatch import fnmatch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+
+def _decode_value(text):
+    """Minimal replacement of `sublime.decode_value` for commented JSON."""
+    text = re.sub(r"^\s*//.*$", "", text, flags=re.M)
+    text = re.sub(r",(\s*[}\]])", r"\1", text)
+    return json.loads(text)
+
+
+sys.modules.setdefault(
+    "sublime",
+    types.SimpleNamespace(decode_value=_decode_value, cache_path=tempfile.gettempdir),
+)
+sys.path.insert(0, ROOT)
+
+from core import commonpath  # noqa: E402
+from core.remoteindex import RemoteIndex  # noqa: E402
+from core.scpfolder import SCPFolder  # noqa: E402
+
+NAMES = ["src", "lib", "cma", "hlp", "lng", "data", "cfg", "test", "doc", "bin"]
+
+
+def make_paths(count, depth=8, seed=0):
+    """Return `count` synthetic absolute paths of up to `depth` components."""
+    rnd = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        parts = [rnd.choice(NAMES) for _ in range(rnd.randint(2, depth))]
+        paths.append(os.path.join(os.sep, "project", *parts))
+    return paths
+
+
+def make_folder(root, dirmaps=50):
+    """Return a `SCPFolder` for `root` with many `dirmap` entries.
+
+    The object is configured without connecting to any host.
+    """
+    config = {
+        "host": "localhost",
+        "dir": "/home/guest",
+        "files": ["*.py", "*.txt", "*.ini", "*.xml"],
+        "dirmap": {
+            "(?:.*/)?%s%d(/.*)?" % (NAMES[i % len(NAMES)], i): "remote/%d/\\1" % i
+            for i in range(dirmaps - 2)
+        },
+    }
+    config["dirmap"]["(?:.*/)?cma(?:/.*)?"] = "oem/data/archive/cma"
+    config["dirmap"]["(?:.*/)?hlp(/.*)?"] = "oem/hmi/hlp/\\1"
+    folder = SCPFolder.__new__(SCPFolder)
+    folder.root = root
+    folder.index = RemoteIndex(folder)
+    folder.configure(config)
+    return folder
+
+
+def to_remote_paths(folder, paths):
+    """Map all `paths` with an empty cache of mapping results."""
+    folder._remote_paths.clear()
+    return [folder.to_remote_path(p) for p in paths]
+
+
+def make_tree(root, count, seed=0):
+    """Create a directory tree with `count` empty files below `root`."""
+    rnd = random.Random(seed)
+    exts = [".py", ".txt", ".ini", ".xml", ".bin", ".log"]
+    for i in range(count):
+        parts = [rnd.choice(NAMES) for _ in range(rnd.randint(1, 5))]
+        path = os.path.join(root, *parts)
+        os.makedirs(path, exist_ok=True)
+        open(os.path.join(path, "f%d%s" % (i, rnd.choice(exts))), "w").close()
+
+
+def scan(folder, path):
+    """Walk and filter a tree the same way `ScpPutCommand.puttree` does."""
+    folder._remote_paths.clear()
+    result = []
+    for root, dirs, files in os.walk(path):
+        arc_path = folder.to_remote_path(root) + "/"
+        for f in files:
+            if folder.files_pattern and not any(
+                fnmatch(f, p) for p in folder.files_pattern
+            ):
+                continue
+            result.append(arc_path + f)
+    return result
+
+
+def measure(func, count, repeat):
+    """Return (best paths per second, peak memory in bytes) of `func`."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count / best if best else float("inf"), peak
+
+
+def benchmarks(sizes, tmp):
+    """Yield (name, number of paths, callable) of all benchmarks."""
+    for count in sizes:
+        paths = make_paths(count)
+        for func in (commonpath.natural, commonpath.most, commonpath.common):
+            yield "commonpath.%s[%d]" % (func.__name__, count), count, (
+                lambda func=func, paths=paths: func(paths)
+            )
+
+        root = os.path.join(os.sep, "project")
+        folder = make_folder(root)
+        dirs = paths[: min(count, 100000)]
+        yield "to_remote_path[%d]" % len(dirs), len(dirs), (
+            lambda folder=folder, dirs=dirs: to_remote_paths(folder, dirs)
+        )
+
+    # file system bound benchmarks use a real, but limited tree
+    count = min(max(sizes), 10000)
+    make_tree(tmp, count)
+    folder = make_folder(tmp)
+    files = [os.path.join(r, f) for r, _, fs in os.walk(tmp) for f in fs]
+    files = [f for f in files if any(fnmatch(f, p) for p in folder.files_pattern)]
+    yield "to_remote_path.files[%d]" % len(files), len(files), (
+        lambda: to_remote_paths(folder, files)
+    )
+    yield "scan[%d]" % count, count, lambda: scan(folder, tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--full", action="store_true", help="include 1M paths")
+    parser.add_argument("--save", action="store_true", help="store new baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="maximum allowed slowdown or memory growth relative to baseline "
+        "(default: 0.3)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sizes = [1000, 10000, 100000] + ([1000000] if args.full else [])
+    try:
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    except (OSError, ValueError):
+        baseline = {}
+
+    results = {}
+    failed = []
+    tmp = tempfile.mkdtemp(prefix="scp_bench_")
+    try:
+        print(
+            "%-32s %14s %10s %12s %10s"
+            % ("benchmark", "paths/s", "baseline", "peak KiB", "baseline")
+        )
+        for name, count, func in benchmarks(sizes, tmp):
+            rate, peak = measure(func, count, args.repeat)
+            results[name] = {"rate": rate, "peak": peak}
+            ref = baseline.get(name) or {}
+            if not isinstance(ref, dict):
+                # baselines of older versions contain the rate only
+                ref = {"rate": ref}
+            ref_rate, ref_peak = ref.get("rate"), ref.get("peak")
+            print(
+                "%-32s %14.0f %s %12.0f %s"
+                % (
+                    name,
+                    rate,
+                    "%9.0f%%" % (100 * rate / ref_rate) if ref_rate else "%10s" % "-",
+                    peak / 1024,
+                    "%9.0f%%" % (100 * peak / ref_peak) if ref_peak else "%10s" % "-",
+                )
+            )
+            if ref_rate and rate < ref_rate * (1.0 - args.tolerance):
+                failed.append(name + " (speed)")
+            if ref_peak and peak > ref_peak * (1.0 + args.tolerance):
+                failed.append(name + " (memory)")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, "w") as file:
+            json.dump(baseline, file, indent=4, sort_keys=True)
+            file.write("\n")
+        print("Baseline saved to", BASELINE)
+
+    if failed:
+        print("\nREGRESSION: %d benchmark(s) worse than baseline:" % len(failed))
+        for name in failed:
+            print("   ", name)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,11 @@
-import os
-import tarfile
-import tempfile
+import time
+
+# Taken before all other imports to record the time importing the plugin and
+# its core modules takes. It is reported by `ScpShowTimingsCommand`.
+_load_start = time.perf_counter()
 
-from fnmatch import fnmatch
+import os
+import posixpath
 
 import sublime
 import sublime_plugin
@@ -10,8 +13,12 @@ import sublime_plugin
 from .core import commonpath
 from .core import scpfolder
 from .core import task
+from .core import timing
 from .core.progress import Progress
+from .core.progress import format_size
+from .core.progress import hub
 
+from .core.scpclient import SCPCancelledError
 from .core.scpclient import SCPCommandError
 from .core.scpclient import SCPNotConnectedError
 
@@ -29,12 +36,24 @@ TEMPLATE = """
 
 
 class _ScpWindowCommand(sublime_plugin.WindowCommand):
+    @timing.timed
     def is_visible(self, paths=None):
         """Menu item is visible, if connection is established."""
         return any(scpfolder.is_connected(path) for path in self.ensure_paths(paths))
 
     def run(self, paths=None):
-        task.call_func(self.executor, self.ensure_paths(paths))
+        paths = self.ensure_paths(paths)
+        task.call_func(self.executor, paths, owners=self.owners(paths))
+
+    def owners(self, paths):
+        """Return the connections of the given paths."""
+        result = set()
+        for path in paths:
+            try:
+                result.add(scpfolder.connection(path, reload=False))
+            except SCPNotConnectedError:
+                pass
+        return result
 
     def ensure_paths(self, paths):
         """If no path was provided, use active view's file name."""
@@ -46,6 +65,7 @@ class _ScpWindowCommand(sublime_plugin.WindowCommand):
 
 
 class ScpMapToRemoteCommand(_ScpWindowCommand):
+    @timing.timed
     def is_visible(self, paths=None):
         """Menu is visible if no mapping exists already."""
         return not any(scpfolder.root_dir(path) for path in self.ensure_paths(paths))
@@ -67,6 +87,7 @@ class ScpConnectCommand(_ScpWindowCommand):
         """Disable command while connection is being established."""
         return not self.thread
 
+    @timing.timed
     def is_visible(self, paths=None):
         """Menu item is visible if mapping exists but offline."""
         return any(
@@ -99,13 +120,18 @@ class ScpCancelCommand(_ScpWindowCommand):
         return task.busy()
 
     def run(self, paths=None):
-        """Abort all queued and active opera"""
-        task.cancel_all()
-        for path in self.ensure_paths(paths):
-            try:
-                scpfolder.connection(path).cancel()
-            except SCPNotConnectedError:
-                pass
+        """Abort queued and active operations of the paths' connections.
+
+        All operations are aborted, if no paths are given.
+        """
+        if paths:
+            for conn in self.owners(paths):
+                task.cancel(conn)
+                conn.cancel()
+        else:
+            task.cancel_all()
+            for conn in list(scpfolder.connections):
+                conn.cancel()
         sublime.status_message("SCP: Aborted!")
 
 
@@ -122,26 +148,41 @@ class ScpGetCommand(_ScpWindowCommand):
                 pass
 
         for conn, paths in groups.items():
-            if len(paths) == 1 and os.path.isfile(paths[0]):
-                # use simple upload for single files
-                conn.getfile(paths[0])
-                msg = "SCP: Downloaded %s!" % paths[0]
-                sublime.status_message(msg)
-            else:
-                # use tarfile upload for multiple files and dirs
-                self.gettree(conn, paths)
+            with conn.operation(), conn.qos.transfer():
+                if len(paths) == 1 and os.path.isfile(paths[0]):
+                    # use simple upload for single files
+                    name = os.path.basename(paths[0])
+                    size = conn.remote_size(conn.to_remote_path(paths[0]))
+                    try:
+                        with hub.add("SCP: downloading %s" % name, size) as status:
+                            conn.getfile(paths[0], status.percent, size)
+                    except SCPCancelledError:
+                        sublime.status_message("SCP: Aborted!")
+                        continue
+                    msg = "SCP: Downloaded %s!" % paths[0]
+                    sublime.status_message(msg)
+                else:
+                    # use tarfile upload for multiple files and dirs
+                    self.gettree(conn, paths)
 
     def gettree(self, conn, paths):
         """
         Download several folders and files to the remote host.
 
-        Uploading many files via scp is horribly slow. To work around that
+        Downloading many files via scp is horribly slow. To work around that
         the following steps are performed:
-        1. Pack all files given via `paths` into a single tar-file with
-           relative paths based on the mapped folder.
-        2. Upload the tar-file to the remote's /tmp/ folder.
-        3. Untar the file on the remote host and delete it.
+        1. Pack all remote files into a single tar-file in the remote's /tmp/.
+        2. Download the tar-file.
+        3. Untar the file locally and delete both tar-files.
+
+        If the remote's /tmp/ has not enough free space, the tar archive is
+        streamed through plink's stdout instead.
         """
+        import tarfile
+        import tempfile
+
+        from .core import chunked
+
         # find common root directory of all paths
         local_dir = commonpath.most(paths)
         remote_dir = conn.to_remote_path(local_dir)
@@ -152,48 +193,87 @@ class ScpGetCommand(_ScpWindowCommand):
 
         remote_tmp = "/tmp/" + os.path.basename(local_tmp)
 
+        status = hub.add("SCP: preparing download ...")
         try:
-            # pack remote files into a tar archive
-            sublime.status_message("SCP: preparing download ...")
-            conn.plink("tar -C {0} -cf {1} .".format(remote_dir, remote_tmp))
-        except SCPCommandError:
-            pass
-
-        try:
-
-            def progress(filename, progress):
-                sublime.status_message("SCP: downloading [{}%] ...".format(progress))
-
-            # download tar archive
-            super(conn.__class__, conn).getfile(remote_tmp, local_tmp, progress)
-
-            # expand tar archive
-            sublime.status_message("SCP: extracting ...")
-            with tarfile.open(local_tmp, "r") as tar:
+            with conn.temporary(
+                remote=[remote_tmp], local=[local_tmp, chunked.partial_path(local_tmp)]
+            ):
+                # the size of the tar archive is about the size of the files
+                size = int(conn.plink("du -sk %s" % remote_dir).split()[0]) * 1024
+                free = conn.free_space("/tmp")
                 os.makedirs(local_dir, exist_ok=True)
-                os.chdir(local_dir)
-                tar.extractall()
+
+                if free is not None and free < 2 * size:
+                    self.streamtree(conn, remote_dir, local_dir, size, status)
+                else:
+                    # pack remote files into a tar archive
+                    conn.plink("tar -C {0} -cf {1} .".format(remote_dir, remote_tmp))
+
+                    # download tar archive
+                    size = conn.stat(remote_tmp).get(remote_tmp, (0, 0))[0]
+                    status.update(message="SCP: downloading", total=size)
+                    conn.download(remote_tmp, local_tmp, status.percent, size)
+
+                    # expand tar archive
+                    status.update(
+                        message="SCP: extracting", total=os.path.getsize(local_tmp)
+                    )
+                    with tarfile.open(local_tmp, "r") as tar:
+                        for member in tar:
+                            conn.check_cancelled()
+                            tar.extract(member, local_dir)
+                            status.advance(member.size)
             sublime.status_message("SCP: Downloaded %s!" % local_dir)
 
-        except SCPCommandError as err:
+        except (SCPCommandError, ValueError, tarfile.TarError) as err:
             print(str(err).strip())
             sublime.status_message("SCP: Failed to download %s!" % local_dir)
 
         finally:
+            status.finish()
             try:
                 # delete remote tar archive
-                super(conn.__class__, conn).remove(remote_tmp)
-            except:
-                pass
-            try:
-                # remove local tar archive
-                os.remove(local_tmp)
+                conn.cleanup(remote_tmp)
             except:
                 pass
+            for tmp in (local_tmp, chunked.partial_path(local_tmp)):
+                try:
+                    # remove local tar archive
+                    os.remove(tmp)
+                except:
+                    pass
+
+    def streamtree(self, conn, remote_dir, local_dir, size, status):
+        """Download a remote directory as tar stream without temporary files."""
+        import tarfile
+
+        status.update(message="SCP: downloading", total=size)
+        reader = conn.stream("tar -C {0} -cf - .".format(remote_dir))
+        try:
+            with tarfile.open(fileobj=reader.stdout, mode="r|") as tar:
+                for member in tar:
+                    conn.check_cancelled()
+                    conn.qos.throttle(member.size, conn.sleep)
+                    tar.extract(member, local_dir)
+                    status.advance(member.size)
+            conn.finish(reader)
+        finally:
+            conn.close(reader)
 
 
 class ScpPutCommand(_ScpWindowCommand):
-    def executor(self, paths):
+    def run(self, paths=None, interactive=False):
+        """Upload files, with reserved bandwidth if `interactive` (on save)."""
+        paths = self.ensure_paths(paths)
+        task.call_func(
+            self.executor,
+            paths,
+            interactive,
+            owners=self.owners(paths),
+            lane=task.INTERACTIVE if interactive else None,
+        )
+
+    def executor(self, paths, interactive=False):
         groups = {}
         for path in paths:
             if any(f in path for f in (".scp", ".git")):
@@ -205,14 +285,22 @@ class ScpPutCommand(_ScpWindowCommand):
                 pass
 
         for conn, paths in groups.items():
-            if len(paths) == 1 and os.path.isfile(paths[0]):
-                # use simple upload for single files
-                conn.putfile(paths[0])
-                msg = "SCP: Uploaded %s!" % paths[0]
-                sublime.status_message(msg)
-            else:
-                # use tarfile upload for multiple files and dirs
-                self.puttree(conn, paths)
+            with conn.operation(), conn.qos.transfer(interactive):
+                if len(paths) == 1 and os.path.isfile(paths[0]):
+                    # use simple upload for single files
+                    name = os.path.basename(paths[0])
+                    size = os.path.getsize(paths[0])
+                    try:
+                        with hub.add("SCP: uploading %s" % name, size) as status:
+                            conn.putfile(paths[0], status.percent)
+                    except SCPCancelledError:
+                        sublime.status_message("SCP: Aborted!")
+                        continue
+                    msg = "SCP: Uploaded %s!" % paths[0]
+                    sublime.status_message(msg)
+                else:
+                    # use tarfile upload for multiple files and dirs
+                    self.puttree(conn, paths)
 
     def puttree(self, conn, paths):
         """
@@ -224,15 +312,29 @@ class ScpPutCommand(_ScpWindowCommand):
            relative paths based on the mapped folder.
         2. Upload the tar-file to the remote's /tmp/ folder.
         3. Untar the file on the remote host and delete it.
+
+        If the remote's /tmp/ has not enough free space, the tar archive is
+        streamed through plink's stdin instead.
         """
+        import tarfile
+        import tempfile
+
+        from fnmatch import fnmatch
+
+        from .core import chunked
+
         local_dir = commonpath.most(paths)
 
         # built temporary local tar-file
         file, local_tmp = tempfile.mkstemp(prefix="scp_")
         os.close(file)
 
-        sublime.status_message("SCP: preparing upload ...")
-        with tarfile.open(local_tmp, "w") as tar:
+        remote_tmp = "/tmp/" + os.path.basename(local_tmp)
+
+        status = hub.add("SCP: preparing upload ...")
+        try:
+            # collect files to upload
+            members = []
             for path in paths:
                 for root, dirs, files in os.walk(path):
                     arc_path = conn.to_remote_path(root) + "/"
@@ -243,42 +345,93 @@ class ScpPutCommand(_ScpWindowCommand):
                             fnmatch(f, p) for p in conn.files_pattern
                         ):
                             continue
+                        members.append((os.path.join(root, f), arc_path + f))
+
+            size = sum(os.path.getsize(name) for name, _ in members)
+            # each member adds a header of 512 bytes and padding up to 512 bytes
+            free = conn.free_space("/tmp")
+            if free is not None and free < size + 1024 * (len(members) + 1):
+                self.streamtree(conn, members, size, status)
+                sublime.status_message("SCP: Uploaded %s!" % local_dir)
+                return
+
+            with conn.temporary(
+                remote=[remote_tmp, remote_tmp + chunked.PARTIAL], local=[local_tmp]
+            ):
+                status.update(message="SCP: packing", total=size)
+                with tarfile.open(local_tmp, "w") as tar:
+                    for name, arcname in members:
                         if conn.debug:
-                            print("Adding", arc_path + f)
-                        tar.add(os.path.join(root, f), arcname=arc_path + f)
-
-        try:
-
-            def progress(filename, progress):
-                sublime.status_message(
-                    "SCP: uploading tarfile [{}%] ...".format(progress)
+                            print("Adding", arcname)
+                        conn.check_cancelled()
+                        tar.add(name, arcname=arcname)
+                        status.advance(os.path.getsize(name))
+
+                # upload using pscp
+                status.update(
+                    message="SCP: uploading", total=os.path.getsize(local_tmp)
                 )
+                conn.upload(local_tmp, remote_tmp, status.percent)
 
-            # upload using pscp
-            remote_tmp = "/tmp/" + os.path.basename(local_tmp)
-            super(conn.__class__, conn).putfile(local_tmp, remote_tmp, progress)
-
-            # untar on remote host and delete temporary archive
-            sublime.status_message("SCP: extracting uploaded tarfile ...")
-            conn.plink("tar -C / -xf {0}; rm -f {0}".format(remote_tmp))
+                # untar on remote host and delete temporary archive
+                status.update(message="SCP: extracting uploaded tarfile ...", total=0)
+                conn.plink("tar -C / -xf {0}; rm -f {0}".format(remote_tmp))
+                conn.index.invalidate()
 
             msg = "SCP: Uploaded %s!" % local_dir
             sublime.status_message(msg)
 
-        except SCPCommandError as err:
+        except (OSError, SCPCommandError) as err:
+            # local files may vanish or be unreadable while being packed
             print(str(err).strip())
             sublime.status_message("SCP: Failed to upload %s!" % local_dir)
+            try:
+                # stop extraction and delete partially uploaded archive
+                conn.cleanup(remote_tmp, remote_tmp + chunked.PARTIAL)
+            except SCPCommandError:
+                pass
 
         finally:
+            status.finish()
             # remove local archive
             os.remove(local_tmp)
 
+    def streamtree(self, conn, members, size, status):
+        """Upload files as tar stream without temporary files."""
+        import tarfile
+
+        status.update(message="SCP: uploading", total=size)
+        writer = conn.stream("tar -C / -xf -", write=True)
+        try:
+            try:
+                with tarfile.open(fileobj=writer.stdin, mode="w|") as tar:
+                    for name, arcname in members:
+                        conn.check_cancelled()
+                        conn.qos.throttle(os.path.getsize(name), conn.sleep)
+                        tar.add(name, arcname=arcname)
+                        status.advance(os.path.getsize(name))
+            except BrokenPipeError:
+                # remote tar closed its stdin, its error is raised below
+                pass
+            finally:
+                # the remote tar waits for EOF, also if packing failed locally
+                try:
+                    writer.stdin.close()
+                except BrokenPipeError:
+                    pass
+            conn.finish(writer)
+        finally:
+            conn.close(writer)
+            conn.index.invalidate()
+
 
 class ScpDelCommand(_ScpWindowCommand):
     def executor(self, paths):
         for path in paths:
             try:
-                scpfolder.connection(path).remove(path)
+                conn = scpfolder.connection(path)
+                with conn.operation():
+                    conn.remove(path)
                 sublime.status_message("SCP: Deleted %s!" % path)
             except SCPNotConnectedError:
                 pass
@@ -287,6 +440,249 @@ class ScpDelCommand(_ScpWindowCommand):
                 sublime.status_message("SCP: Could not delete %s!" % path)
 
 
+class ScpCopyToCommand(_ScpWindowCommand):
+    """
+    Copy folders and files from one remote host to another.
+
+    The files to copy are collected from the local selection the same way
+    `ScpPutCommand.puttree` does, filtered by the source's `files` patterns.
+    Each directory is mapped through the source's and the destination's
+    `dirmap` as if it was located in the destination's mapped folder.
+
+    The source's `tar -cf -` output of exactly these files is piped into the
+    destination's `tar -xf -` through two plink streams, while the members
+    are renamed to their destination paths, without writing anything to
+    local disk.
+    """
+
+    def run(self, paths=None):
+        paths = self.ensure_paths(paths)
+        owners = self.owners(paths)
+        if len(owners) != 1:
+            return
+        source = owners.pop()
+        targets = [c for c in scpfolder.connections if c is not source]
+        if not targets:
+            sublime.status_message("SCP: No other connection to copy to!")
+            return
+
+        def on_select(index):
+            if index >= 0:
+                target = targets[index]
+                task.call_func(
+                    self.executor, source, target, paths, owners=[source, target]
+                )
+
+        self.window.show_quick_panel(
+            [[c.root, "%s@%s:%s" % (c.user, c.host, c.remote_dir)] for c in targets],
+            on_select,
+        )
+
+    def executor(self, source, target, paths):
+        with source.operation(), target.operation():
+            with source.qos.transfer(), target.qos.transfer():
+                try:
+                    self.copytree(source, target, paths)
+                    sublime.status_message("SCP: Copied to %s!" % target.root)
+                except SCPCommandError as err:
+                    print(str(err).strip())
+                    sublime.status_message("SCP: Failed to copy to %s!" % target.root)
+                finally:
+                    target.index.invalidate()
+
+    def members(self, source, target, paths):
+        """Return local, source and destination paths of all files to copy."""
+        from fnmatch import fnmatch
+
+        members = []
+        for path in paths:
+            if os.path.isdir(path):
+                walk = os.walk(path)
+            else:
+                walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+            for root, dirs, files in walk:
+                try:
+                    src_dir = source.to_remote_path(root)
+                    dst_dir = target.to_remote_path(
+                        os.path.join(target.root, source.relpath(root))
+                    )
+                except ValueError:
+                    continue
+                for f in files:
+                    if source.files_pattern and not any(
+                        fnmatch(f, p) for p in source.files_pattern
+                    ):
+                        continue
+                    members.append(
+                        (
+                            os.path.join(root, f),
+                            posixpath.join(src_dir, f),
+                            posixpath.join(dst_dir, f),
+                        )
+                    )
+        return members
+
+    def copytree(self, source, target, paths):
+        import tarfile
+
+        members = self.members(source, target, paths)
+        if not members:
+            return
+        # tar strips the leading slash of member names
+        names = {src.lstrip("/"): dst.lstrip("/") for _, src, dst in members}
+
+        status = hub.add(
+            "SCP: copying to %s" % target.host,
+            sum(os.path.getsize(local) for local, _, _ in members),
+        )
+        reader = writer = None
+        try:
+            reader = source.stream(
+                "tar -C / -cf - -T -", feed="".join(n + "\n" for n in names).encode()
+            )
+            writer = target.stream("tar -C / -xf -", write=True)
+            try:
+                with tarfile.open(fileobj=reader.stdout, mode="r|") as src:
+                    with tarfile.open(fileobj=writer.stdin, mode="w|") as dst:
+                        for member in src:
+                            source.check_cancelled()
+                            target.check_cancelled()
+                            if member.name not in names:
+                                continue
+                            member.name = names[member.name]
+                            target.qos.throttle(member.size, target.sleep)
+                            data = src.extractfile(member) if member.isfile() else None
+                            dst.addfile(member, data)
+                            status.advance(member.size)
+            except BrokenPipeError:
+                # destination closed its stdin, its error is raised below
+                source.close(reader)
+            finally:
+                try:
+                    writer.stdin.close()
+                except BrokenPipeError:
+                    pass
+            target.finish(writer)
+            source.finish(reader)
+        finally:
+            status.finish()
+            if reader:
+                source.close(reader)
+            if writer:
+                target.close(writer)
+
+
+class ScpBrowseCommand(_ScpWindowCommand):
+    """
+    Browse the remote directory tree of a mapped folder via quick panel.
+
+    Selecting a directory shows its content, selecting a file copies it to
+    a temporary location and opens it. Remote files are downloaded only if
+    the local file cache doesn't hold the current version.
+    """
+
+    def run(self, paths=None):
+        paths = self.ensure_paths(paths)
+        if paths:
+            task.call_func(self.executor, paths[0], owners=self.owners(paths))
+
+    def executor(self, path):
+        try:
+            conn = scpfolder.connection(path)
+            if not os.path.isdir(path):
+                path = os.path.dirname(path)
+            with conn.operation():
+                self.browse(conn, conn.to_remote_path(path))
+        except (SCPNotConnectedError, ValueError):
+            pass
+
+    def browse(self, conn, remote):
+        try:
+            entries = conn.index.listdir(remote)
+        except SCPCommandError as err:
+            print(str(err).strip())
+            sublime.status_message("SCP: Could not list %s!" % remote)
+            return
+
+        items = [[".. (parent directory)", remote], ["Search in subtree...", remote]]
+        for entry in entries:
+            if entry.type == "d":
+                items.append([entry.name + "/", "directory"])
+            else:
+                items.append(
+                    [
+                        entry.name,
+                        "{}  {}".format(
+                            format_size(entry.size),
+                            time.strftime(
+                                "%Y-%m-%d %H:%M", time.localtime(entry.mtime)
+                            ),
+                        ),
+                    ]
+                )
+
+        def on_select(index):
+            if index == 0:
+                self.call(self.browse, conn, posixpath.dirname(remote))
+            elif index == 1:
+                self.call(self.search, conn, remote)
+            elif index > 1:
+                entry = entries[index - 2]
+                child = posixpath.join(remote, entry.name)
+                if entry.type == "d":
+                    self.call(self.browse, conn, child)
+                else:
+                    self.call(self.open, conn, child)
+
+        sublime.set_timeout(lambda: self.window.show_quick_panel(items, on_select))
+
+    def search(self, conn, remote):
+        sublime.status_message("SCP: indexing %s ..." % remote)
+        try:
+            files = [(p, e) for p, e in conn.index.find(remote) if e.type != "d"]
+        except SCPCommandError as err:
+            print(str(err).strip())
+            sublime.status_message("SCP: Could not index %s!" % remote)
+            return
+
+        items = [[p, format_size(e.size)] for p, e in files]
+
+        def on_select(index):
+            if index >= 0:
+                child = posixpath.join(remote, files[index][0])
+                self.call(self.open, conn, child)
+
+        sublime.set_timeout(lambda: self.window.show_quick_panel(items, on_select))
+
+    @staticmethod
+    def call(func, conn, remote):
+        """Queue a cancellable operation of `conn`."""
+
+        def run():
+            with conn.operation():
+                func(conn, remote)
+
+        task.call_func(run, owners=[conn])
+
+    def open(self, conn, remote):
+        import tempfile
+
+        from .core import filecache
+
+        local = os.path.join(
+            tempfile.gettempdir(), "scp", conn.host, *remote.strip("/").split("/")
+        )
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        try:
+            sublime.status_message("SCP: opening %s ..." % remote)
+            filecache.instance().fetch(conn, remote, local)
+        except (OSError, SCPCommandError) as err:
+            print(str(err).strip())
+            sublime.status_message("SCP: Could not download %s!" % remote)
+            return
+        sublime.set_timeout(lambda: self.window.open_file(local))
+
+
 class NewFileNameInputHandler(sublime_plugin.TextInputHandler):
     def __init__(self, view):
         self.view = view
@@ -320,7 +716,9 @@ class ScpRenameFileCommand(_ScpWindowCommand):
         try:
             new_path = view.file_name()
             if new_path != old_path:
-                scpfolder.connection(old_path).rename(old_path, new_path)
+                conn = scpfolder.connection(old_path)
+                with conn.operation():
+                    conn.rename(old_path, new_path)
                 sublime.status_message("SCP: Renamed to %s!" % new_path)
         except SCPNotConnectedError:
             pass
@@ -342,4 +740,15 @@ class ScpRenameFileCommand(_ScpWindowCommand):
 
 class ScpEventListener(sublime_plugin.EventListener):
     def on_post_save(self, view):
-        view.window().run_command("scp_put")
+        if scpfolder.is_connected(view.file_name()):
+            view.window().run_command("scp_put", {"interactive": True})
+
+
+class ScpShowTimingsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        """Print time spent importing the plugin and in menu visibility checks."""
+        print(timing.report())
+        self.window.run_command("show_panel", {"panel": "console"})
+
+
+timing.record("import", time.perf_counter() - _load_start)
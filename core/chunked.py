@@ -0,0 +1,221 @@
+import hashlib
+import os
+import posixpath
+import shutil
+import tempfile
+
+from .scpclient import SCPCancelledError
+from .scpclient import SCPClient
+from .scpclient import SCPCommandError
+
+#: Default size of a single chunk
+CHUNK_SIZE = 8 * 2 ** 20
+
+#: Default number of retries of a failed chunk
+RETRIES = 5
+
+#: Delay before the first retry, which is doubled with each further retry
+BACKOFF = 1.0
+
+#: Suffix of partially transferred files
+PARTIAL = ".scp-part"
+
+# Append a remote chunk to the partial file truncated to the expected offset,
+# if the chunk is valid, and print the new size of the partial file.
+_REMOTE_APPEND = (
+    'c="{0}"; p="{1}"; '
+    '[ "$(md5sum < "$c" | cut -d" " -f1)" = "{2}" ] && '
+    'dd if=/dev/null of="$p" bs=1 seek={3} 2>/dev/null && cat "$c" >> "$p"; '
+    'rm -f "$c"; stat -c %s "$p"'
+)
+
+# Copy a chunk of a remote file to a temporary file and print its checksum.
+_REMOTE_CHUNK = (
+    'dd if="{0}" of="{1}" bs={2} skip={3} count=1 2>/dev/null && md5sum "{1}"'
+)
+
+
+def _retry(client, func, retries, backoff):
+    """Call `func` until it succeeds, with exponentially increasing delays."""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except SCPCancelledError:
+            raise
+        except SCPCommandError as err:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print("SCP: %s, retrying in %.0fs ..." % (str(err).strip(), delay))
+            client.sleep(delay)
+
+
+def _md5(path, size):
+    """Return the md5 object of the first `size` bytes of a local file."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as src:
+        while size:
+            block = src.read(min(size, 2 ** 16))
+            if not block:
+                break
+            md5.update(block)
+            size -= len(block)
+    return md5
+
+
+def partial_path(local):
+    """Return the path of the partial file of a download to `local`."""
+    digest = hashlib.md5(os.path.abspath(local).encode()).hexdigest()
+    return os.path.join(tempfile.gettempdir(), "scp_%s%s" % (digest, PARTIAL))
+
+
+def _progress(on_progress, name, done, total):
+    if callable(on_progress):
+        on_progress(name, int(100 * done / total) if total else 100)
+
+
+def putfile(
+    client,
+    local,
+    remote,
+    chunk_size=CHUNK_SIZE,
+    retries=RETRIES,
+    backoff=BACKOFF,
+    on_progress=None,
+):
+    """Upload a file in verified chunks.
+
+    The chunks are appended to a partial file next to `remote`, which is
+    renamed to `remote` as soon as all chunks are transferred. The partial
+    file is kept if the upload fails, so a later call continues at the end
+    of the last valid chunk.
+
+    :raises:
+        `SCPCommandError` if a chunk still fails after all retries.
+    """
+    name = os.path.basename(local)
+    total = os.path.getsize(local)
+    partial = remote + PARTIAL
+    client.plink("mkdir -p %s" % posixpath.dirname(remote))
+
+    # resume only if the partial file is a prefix of the local file
+    offset = client.stat(partial).get(partial, (0, 0))[0]
+    if 0 < offset <= total:
+        out = client.plink('head -c %d "%s" | md5sum' % (offset, partial))
+        if out.split()[:1] != [_md5(local, offset).hexdigest()]:
+            offset = 0
+    else:
+        offset = 0
+
+    file, tmp = tempfile.mkstemp(prefix="scp_")
+    os.close(file)
+    with client.temporary(remote=[partial + ".chunk"], local=[tmp]):
+        try:
+            with open(local, "rb") as src:
+                while offset < total:
+                    src.seek(offset)
+                    data = src.read(chunk_size)
+                    with open(tmp, "wb") as out:
+                        out.write(data)
+
+                    def send(offset=offset, checksum=hashlib.md5(data).hexdigest()):
+                        SCPClient.putfile(client, tmp, partial + ".chunk")
+                        size = client.plink(
+                            _REMOTE_APPEND.format(
+                                partial + ".chunk", partial, checksum, offset
+                            )
+                        )
+                        size = int(size.strip() or 0)
+                        if size != offset + len(data):
+                            # the partial file is truncated to offset on retry
+                            raise SCPCommandError("invalid chunk at %d" % offset)
+                        return size
+
+                    offset = _retry(client, send, retries, backoff)
+                    _progress(on_progress, name, offset, total)
+
+            client.plink('mv -f "%s" "%s"' % (partial, remote))
+        finally:
+            os.remove(tmp)
+
+
+def getfile(
+    client,
+    remote,
+    local,
+    chunk_size=CHUNK_SIZE,
+    retries=RETRIES,
+    backoff=BACKOFF,
+    on_progress=None,
+):
+    """Download a file in verified chunks.
+
+    The chunks are appended to a partial file in the local temporary folder,
+    which is moved to `local` as soon as all chunks are transferred and the
+    checksum of the whole file matches the remote one. The partial file is
+    kept if the download fails, so a later call continues with the last
+    incomplete chunk, if the remote file didn't change meanwhile.
+
+    :raises:
+        `SCPCommandError` if the remote file doesn't exist, a chunk still
+        fails after all retries or the checksum of the whole file mismatches.
+    """
+    name = posixpath.basename(remote)
+    stat = client.stat(remote).get(remote)
+    if stat is None:
+        raise SCPCommandError("No such file %s" % remote)
+    total = stat[0]
+    partial = partial_path(local)
+    remote_tmp = "/tmp/scp_%s.chunk" % hashlib.md5(remote.encode()).hexdigest()
+
+    # resume at the last complete chunk, if it is a prefix of the remote file
+    try:
+        offset = os.path.getsize(partial)
+    except OSError:
+        offset = 0
+    if offset > total:
+        offset = 0
+    offset -= offset % chunk_size
+    md5 = _md5(partial, offset) if offset else hashlib.md5()
+    if offset:
+        out = client.plink('head -c %d "%s" | md5sum' % (offset, remote))
+        if out.split()[:1] != [md5.hexdigest()]:
+            offset = 0
+            md5 = hashlib.md5()
+
+    file, tmp = tempfile.mkstemp(prefix="scp_")
+    os.close(file)
+    with client.temporary(remote=[remote_tmp], local=[tmp]):
+        try:
+            with open(partial, "ab") as dst:
+                dst.truncate(offset)
+                while offset < total:
+
+                    def receive(index=offset // chunk_size):
+                        out = client.plink(
+                            _REMOTE_CHUNK.format(remote, remote_tmp, chunk_size, index)
+                        )
+                        SCPClient.getfile(client, remote_tmp, tmp)
+                        with open(tmp, "rb") as src:
+                            data = src.read()
+                        checksum = hashlib.md5(data).hexdigest()
+                        if not data or out.split()[:1] != [checksum]:
+                            raise SCPCommandError("invalid chunk %d" % index)
+                        return data
+
+                    data = _retry(client, receive, retries, backoff)
+                    dst.write(data)
+                    dst.flush()
+                    md5.update(data)
+                    offset += len(data)
+                    _progress(on_progress, name, offset, total)
+
+            # the remote file may have changed while chunks were transferred
+            out = client.plink('md5sum "%s"' % remote)
+            if out.split()[:1] != [md5.hexdigest()]:
+                os.remove(partial)
+                raise SCPCommandError("Checksum mismatch after downloading %s" % remote)
+            shutil.move(partial, local)
+        finally:
+            os.remove(tmp)
+            client.cleanup(remote_tmp)
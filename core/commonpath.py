@@ -1,5 +1,4 @@
 import re
-from collections import defaultdict, Counter
 from os.path import sep, normpath
 
 
@@ -46,6 +45,17 @@ def common(paths, max_depth=None):
     return CommonPath(paths).common(max_depth)
 
 
+class _Node(object):
+    __slots__ = ("name", "parent", "children", "count", "order")
+
+    def __init__(self, name, parent, order):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.count = 0
+        self.order = order
+
+
 class CommonPath(object):
     #: Default maximum path depth to analyse
     default_max_depth = 99
@@ -54,66 +64,99 @@ class CommonPath(object):
     #: Reduce the minimum required frequency at increasing depth
     depth_red_freq = 0.10
 
-    def __init__(self, paths):
-        #: List of paths to analyse
-        self.paths = [normpath(p) for p in paths]
-        #: Most common path for different path depths
-        self.most_common = self._most_common()
-
-    def _most_common(self):
-        split_paths = [
-            re.split("[\\\\/]+", p) for p in self.paths
-        ]  # Allow both `\` and `/` as separator
-        # Dict of list of unpacked paths with path depth level as keys
-        # e.g. {0: ['', '', ''],
-        #       1: ['/home', '/home', '/usr'],
-        #       2: ['/home/user1', '/home/user1', '/usr/bin']}
-        levels = defaultdict(list)
-        for split_path in split_paths:
-            for level, ele in enumerate(split_path):
-                levels[level].append(
-                    sep.join(split_path[0 : level + 1])
-                )  # Return with the system's separator
-
-        # List of tuples (most common path, count) by increasing path depth
-        # e.g. [('', 3),
-        #       ('/home', 2),
-        #       ('/home/user1', 2)]
-        return [Counter(level).most_common(1)[0] for level in levels.values()]
+    def __init__(self, paths=()):
+        #: Number of analysed paths
+        self.count = 0
+        # Trie of path components with the number of paths passing each node
+        self._root = _Node(None, None, -1)
+        # Most common node for each path depth
+        self._best = []
+        self._nodes = 0
+        self.update(paths)
+
+    def add(self, path):
+        """Add a single path to analyse."""
+        node = self._root
+        # Allow both `\` and `/` as separator
+        for depth, name in enumerate(re.split("[\\\\/]+", normpath(path))):
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = _Node(name, node, self._nodes)
+                self._nodes += 1
+            child.count += 1
+            if depth == len(self._best):
+                self._best.append(child)
+            else:
+                # On equal counts prefer the path which was seen first
+                best = self._best[depth]
+                if child.count > best.count or (
+                    child.count == best.count and child.order < best.order
+                ):
+                    self._best[depth] = child
+            node = child
+        self.count += 1
+
+    def update(self, paths):
+        """Add several paths to analyse."""
+        for path in paths:
+            self.add(path)
+
+    @property
+    def most_common(self):
+        """List of tuples (most common path, count) by increasing path depth.
+
+        e.g. [('', 3),
+              ('/home', 2),
+              ('/home/user1', 2)]
+        """
+        return [(self._path(node), node.count) for node in self._best]
 
     def natural(self, max_depth=None):
         """Return the "natural" deepest common path."""
         max_depth = max_depth or self.default_max_depth
-        min_count = min(self.min_freq * len(self.paths), self.most_common[0][1])
+        if not self._best:
+            return None
+        min_count = min(self.min_freq * self.count, self._best[0].count)
         result = None
-        for i, common in enumerate(self.most_common):
-            if common[1] < round(min_count, 0) or i > max_depth - 1:
+        for i, node in enumerate(self._best):
+            if node.count < round(min_count, 0) or i > max_depth - 1:
                 break
             else:
-                result = common[0]
+                result = node
                 min_count *= 1 - self.depth_red_freq
-        return result
+        return self._path(result)
 
     def most(self, max_depth=None):
         """Return the most common path."""
         max_depth = max_depth or self.default_max_depth
         max_count = 0
         result = None
-        for i, common in enumerate(self.most_common):
-            if common[1] < max_count or i > max_depth - 1:
+        for i, node in enumerate(self._best):
+            if node.count < max_count or i > max_depth - 1:
                 break
             else:
-                max_count = common[1]
-                result = common[0]
-        return result
+                max_count = node.count
+                result = node
+        return self._path(result)
 
     def common(self, max_depth=None):
         """Return the real common deepest path"""
         max_depth = max_depth or self.default_max_depth
         result = None
-        for i, common in enumerate(self.most_common):
-            if common[1] < len(self.paths) or i > max_depth - 1:
+        for i, node in enumerate(self._best):
+            if node.count < self.count or i > max_depth - 1:
                 break
             else:
-                result = common[0]
-        return result
+                result = node
+        return self._path(result)
+
+    @staticmethod
+    def _path(node):
+        """Return the path of a trie node with the system's separator."""
+        if node is None:
+            return None
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return sep.join(reversed(names))
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import tempfile
+
+from .scpclient import SCPClient
+from .scpclient import SCPCommandError
+
+#: Default size of the blocks to compare
+BLOCK_SIZE = 2 ** 20
+
+#: Maximum ratio of changed blocks to still prefer a delta over a full upload
+MAX_CHANGED_RATIO = 0.5
+
+# Print md5 checksums of all blocks of a remote file, nothing if it is missing.
+_REMOTE_SUMS = (
+    'f="{0}"; [ -f "$f" ] || exit 0; '
+    "n=$(( ($(stat -c %s \"$f\") + {1} - 1) / {1} )); i=0; "
+    "while [ $i -lt $n ]; do "
+    'dd if="$f" bs={1} skip=$i count=1 2>/dev/null | md5sum; i=$((i+1)); '
+    "done"
+)
+
+# Patch changed blocks into a remote file, truncate it and print its checksum.
+_REMOTE_PATCH = (
+    'f="{0}"; p="{1}"; j=0; '
+    "for i in {2}; do "
+    'dd if="$p" of="$f" bs={3} skip=$j seek=$i count=1 conv=notrunc 2>/dev/null'
+    " || exit 1; j=$((j+1)); "
+    "done; "
+    'dd if=/dev/null of="$f" bs=1 seek={4} 2>/dev/null; rm -f "$p"; md5sum "$f"'
+)
+
+
+def local_checksums(path, block_size=BLOCK_SIZE):
+    """Return the list of md5 checksums of all blocks of a local file."""
+    sums = []
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sums.append(hashlib.md5(block).hexdigest())
+    return sums
+
+
+def remote_checksums(client, remote, block_size=BLOCK_SIZE):
+    """Return the list of md5 checksums of all blocks of a remote file.
+
+    The checksums are calculated by the remote using `dd` and `md5sum`.
+    An empty list is returned if the remote file does not exist.
+    """
+    out = client.plink(_REMOTE_SUMS.format(remote, block_size))
+    return [line.split()[0] for line in out.splitlines() if line.strip()]
+
+
+def putfile(client, local, remote, block_size=BLOCK_SIZE, on_progress=None):
+    """Update a remote file by sending only the blocks which differ.
+
+    1. Calculate per-block checksums of the local and the remote file.
+    2. Upload all changed blocks as one patch file to the remote's /tmp/.
+    3. Patch the blocks into the remote file, truncate it to the local size
+       and compare the checksum of the whole file.
+
+    :returns:
+        ``True`` if the remote file was updated, ``False`` if a full upload
+        is required as the remote file doesn't exist or too much changed.
+
+    :raises:
+        `SCPCommandError` if patching failed or the final checksum mismatches.
+    """
+    remote_sums = remote_checksums(client, remote, block_size)
+    if not remote_sums:
+        return False
+
+    local_sums = local_checksums(local, block_size)
+    changed = [
+        i
+        for i, checksum in enumerate(local_sums)
+        if i >= len(remote_sums) or remote_sums[i] != checksum
+    ]
+    if len(changed) > MAX_CHANGED_RATIO * len(local_sums):
+        return False
+
+    file, patch = tempfile.mkstemp(prefix="scp_")
+    remote_patch = "/tmp/" + os.path.basename(patch)
+    with client.temporary(remote=[remote_patch], local=[patch]):
+        try:
+            with os.fdopen(file, "wb") as out, open(local, "rb") as src:
+                for i in changed:
+                    src.seek(i * block_size)
+                    out.write(src.read(block_size))
+
+            try:
+                if changed:
+                    SCPClient.putfile(client, patch, remote_patch, on_progress)
+
+                out = client.plink(
+                    _REMOTE_PATCH.format(
+                        remote,
+                        remote_patch,
+                        " ".join(map(str, changed)),
+                        block_size,
+                        os.path.getsize(local),
+                    )
+                )
+            except SCPCommandError:
+                client.cleanup(remote_patch)
+                raise
+        finally:
+            os.remove(patch)
+
+    md5 = hashlib.md5()
+    with open(local, "rb") as src:
+        for block in iter(lambda: src.read(block_size), b""):
+            md5.update(block)
+    if not out.split() or out.split()[0] != md5.hexdigest():
+        raise SCPCommandError("Checksum mismatch after patching %s" % remote)
+    return True
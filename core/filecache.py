@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import sublime
+
+from .scpclient import SCPClient
+from .scpclient import SCPCommandError
+
+
+class FileCache(object):
+
+    """
+    A content addressed local cache of downloaded remote files.
+
+    Downloaded files are stored as blobs named by the sha256 of their content,
+    so files which are identical on several hosts are stored only once. An
+    index maps host and remote path to the size, modification time and blob of
+    the remote file. Least recently used blobs are evicted as soon as the
+    total size of all blobs exceeds `max_size`.
+    """
+
+    #: Maximum total size of all cached blobs in bytes
+    max_size = 256 * 2 ** 20
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.blob_dir = os.path.join(path, "blobs")
+        self.index_file = os.path.join(path, "index.json")
+        if max_size is not None:
+            self.max_size = max_size
+        self._lock = threading.Lock()
+        # {key: [size, mtime, hash]}
+        self._files = None
+        # {hash: [size, atime]}
+        self._blobs = None
+
+    def fetch(self, client, remote, local, stat=None, on_progress=None):
+        """Copy the content of a remote file to `local`.
+
+        The file is downloaded only if the cache doesn't contain a valid copy.
+
+        :param client:
+            The `SCPClient` to download the file with.
+        :param remote:
+            The remote path of the file to fetch.
+        :param local:
+            The local path to copy the file content to.
+        :param stat:
+            The ``(size, mtime)`` of the remote file if already known.
+            If ``None`` it is queried with a single remote `stat` call.
+
+        :returns:
+            ``True`` if the file was served from cache, ``False`` if downloaded.
+
+        :raises:
+            `SCPCommandError` if the remote file does not exist or the download
+            failed.
+        """
+        if stat is None:
+            stat = client.stat(remote).get(remote)
+            if stat is None:
+                raise SCPCommandError("No such file %s" % remote)
+        stat = [int(stat[0]), int(stat[1])]
+        key = "%s@%s:%s:%s" % (client.user, client.host, client.port, remote)
+
+        with self._lock:
+            self._load()
+            entry = self._files.get(key)
+            if entry and entry[:2] == stat and entry[2] in self._blobs:
+                blob = self._blob_path(entry[2])
+                if os.path.isfile(blob):
+                    self._blobs[entry[2]][1] = time.time()
+                    self._save()
+                    shutil.copyfile(blob, local)
+                    return True
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+        tmp = os.path.join(self.path, "download_%d" % threading.get_ident())
+        try:
+            SCPClient.getfile(client, remote, tmp, on_progress)
+            digest = self._hash(tmp)
+            with self._lock:
+                blob = self._blob_path(digest)
+                if os.path.isfile(blob):
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, blob)
+                self._files[key] = stat + [digest]
+                self._blobs[digest] = [os.path.getsize(blob), time.time()]
+                # copy before evicting, which removes blobs above `max_size`
+                shutil.copyfile(blob, local)
+                self._evict()
+                self._save()
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return False
+
+    def clear(self):
+        """Remove all cached files."""
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._files = {}
+            self._blobs = {}
+
+    def _evict(self):
+        """Remove least recently used blobs until the cache fits `max_size`."""
+        total = sum(size for size, _ in self._blobs.values())
+        if total <= self.max_size:
+            return
+        for digest, (size, _) in sorted(self._blobs.items(), key=lambda i: i[1][1]):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+            del self._blobs[digest]
+            total -= size
+        self._files = {k: v for k, v in self._files.items() if v[2] in self._blobs}
+
+    def _load(self):
+        if self._files is not None:
+            return
+        try:
+            with open(self.index_file) as file:
+                data = json.load(file)
+            self._files = data["files"]
+            self._blobs = data["blobs"]
+        except (OSError, ValueError, KeyError):
+            self._files = {}
+            self._blobs = {}
+
+    def _save(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump({"files": self._files, "blobs": self._blobs}, file)
+        os.replace(tmp, self.index_file)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    @staticmethod
+    def _hash(path):
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(2 ** 16), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+
+## [ default file cache ] ####################################################
+
+
+_cache = None
+
+
+def instance():
+    """Return the default file cache, which is located in Sublime's cache path."""
+    global _cache
+    if _cache is None:
+        _cache = FileCache(os.path.join(sublime.cache_path(), "SCP"))
+    return _cache
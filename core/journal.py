@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+
+import sublime
+
+from .scpclient import SCPCommandError
+
+
+class Journal(object):
+
+    """
+    A persistent list of temporary files created by a connection.
+
+    Files are added before they are created and removed after they were
+    deleted, so files left behind by failed transfers or a crashed plugin
+    host are known and removed by the next `sweep()`. Files of transfers,
+    which are still running, are skipped by `sweep()`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._active = set()
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            self._remote = set(data["remote"])
+            self._local = set(data["local"])
+        except (OSError, ValueError, KeyError):
+            self._remote = set()
+            self._local = set()
+
+    @contextmanager
+    def track(self, remote=(), local=()):
+        """Record temporary files for the duration of the context.
+
+        The caller is responsible to delete them. Remote files are expected
+        to be deleted, if the context is left without an error. Local files,
+        which still exist after the context was left, and remote files of a
+        failed context, which were not passed to `forget()`, are removed by
+        the next `sweep()`.
+        """
+        entries = [("r", r) for r in remote] + [("l", l) for l in local]
+        with self._lock:
+            self._remote.update(remote)
+            self._local.update(local)
+            self._active.update(entries)
+            self._save()
+        succeeded = False
+        try:
+            yield self
+            succeeded = True
+        finally:
+            with self._lock:
+                self._active.difference_update(entries)
+                if succeeded:
+                    self._remote.difference_update(remote)
+                self._local.difference_update(
+                    path for path in local if not os.path.exists(path)
+                )
+                self._save()
+
+    def forget(self, remote=()):
+        """Remove remote files from the journal, which are known to be deleted."""
+        with self._lock:
+            self._remote.difference_update(remote)
+            self._save()
+
+    def sweep(self, client):
+        """Delete all recorded files, which are not in use.
+
+        Remote files are deleted by a single batched command.
+        """
+        with self._lock:
+            remote = [r for r in self._remote if ("r", r) not in self._active]
+            local = [l for l in self._local if ("l", l) not in self._active]
+        if remote:
+            try:
+                client.cleanup(*remote)
+            except (OSError, SCPCommandError) as err:
+                print("SCP: sweeping remote temporary files failed,", err)
+                remote = []
+        removed = []
+        for path in local:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            removed.append(path)
+        with self._lock:
+            self._remote.difference_update(remote)
+            self._local.difference_update(removed)
+            self._save()
+        if client.debug and (remote or removed):
+            print("SCP: swept", remote + removed)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(
+                {"remote": sorted(self._remote), "local": sorted(self._local)}, file
+            )
+        os.replace(tmp, self.path)
+
+
+## [ journals by host ] ######################################################
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def journal(client):
+    """Return the journal of the host `client` is connected to.
+
+    Connections to the same host share a journal, as they share its /tmp.
+    """
+    name = "journal-%s@%s_%s.json" % (client.user, client.host, client.port)
+    path = os.path.join(sublime.cache_path(), "SCP", name)
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = Journal(path)
+        return _journals[path]
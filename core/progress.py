@@ -1,67 +1,235 @@
+import threading
+import time
+
 import sublime
 
 
-class Progress(object):
-    def __init__(self, message):
-        self.message = message
-        self.addend = 1
-        self.size = 8
-        self.last_view = None
-        self.window = None
-        self.running = False
+def format_size(size):
+    """Return human readable representation of a number of bytes."""
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024.0
+    return "%d %s" % (size, unit) if unit == "B" else "%.1f %s" % (size, unit)
 
-    def __enter__(self):
-        """Start progress bar."""
-        self.start()
-        return self
 
-    def __exit__(self, type, value, traceback):
-        """Stop progress bar."""
-        self.running = False
+def format_time(seconds):
+    """Return human readable representation of a duration."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
 
-    def start(self):
-        sublime.set_timeout(lambda: self._update(0), 100)
-        self.running = True
 
-    def done(self, message):
-        """Stop and print finalization message."""
-        self.running = False
-        self._paint(message)
-        sublime.set_timeout(lambda: self._paint(None), 2000)
-
-    def _update(self, i):
-        """Update busy indicator and paint it."""
-        if not self.running:
-            return
+class ProgressTask(object):
 
-        before = i % self.size
-        after = (self.size - 1) - before
+    """
+    The progress of a single operation reported to the `ProgressHub`.
 
-        self._paint("[%s➖%s] %s" % (" " * before, " " * after, self.message))
+    A task with a `total` of 0 has no known size and is displayed as busy
+    indicator, others display percentage, throughput and ETA.
+    """
 
-        if not after:
-            self.addend = -1
-        if not before:
-            self.addend = 1
-        i += self.addend
+    def __init__(self, hub, message, total=0):
+        self.hub = hub
+        self.message = message
+        self.total = total
+        self.current = 0
+        self.started = time.monotonic()
 
-        sublime.set_timeout(lambda: self._update(i), 100)
+    def __enter__(self):
+        return self
 
-    def _paint(self, message):
+    def __exit__(self, type, value, traceback):
+        self.finish()
+
+    def update(self, current=None, message=None, total=None):
+        """Update state of the task.
+
+        Changing the `message` starts a new stage and resets the throughput.
+        """
+        if message is not None and message != self.message:
+            self.message = message
+            self.current = 0
+            self.started = time.monotonic()
+        if total is not None:
+            self.total = total
+        if current is not None:
+            self.current = current
+        self.hub.notify()
+
+    def advance(self, amount):
+        """Add `amount` bytes to the current state."""
+        self.current += amount
+        self.hub.notify()
+
+    def percent(self, filename, percent):
+        """Update the current state by percentage, to be used as `on_progress`."""
+        self.update(current=self.total * int(percent) // 100)
+
+    def finish(self):
+        self.hub.remove(self)
+
+
+class ProgressHub(object):
+
+    """
+    Collect progress of all active operations and paint them to the status bar.
+
+    Repaints are scheduled on demand only, limited to one per `interval` and
+    skipped if the text doesn't change. Only a busy indicator of tasks with
+    unknown size keeps repainting periodically.
+    """
+
+    #: Minimum time between two repaints in seconds
+    interval = 0.2
+    #: Width of the busy indicator
+    size = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._scheduled = False
+        self._painted = 0
+        self._step = 0
+        self._text = None
+        self._flash = None
+        self._view = None
+
+    def add(self, message, total=0):
+        """Add and return a new `ProgressTask`."""
+        task = ProgressTask(self, message, total)
+        with self._lock:
+            self._tasks.append(task)
+        self.notify()
+        return task
+
+    def remove(self, task):
+        with self._lock:
+            if task in self._tasks:
+                self._tasks.remove(task)
+        self.notify()
+
+    def notify(self):
+        """Schedule a repaint, unless one is pending already."""
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+            delay = self.interval - (time.monotonic() - self._painted)
+        sublime.set_timeout(self._update, max(0, int(delay * 1000)))
+
+    def render(self):
+        """Return the status text of all active tasks."""
+        with self._lock:
+            tasks = list(self._tasks)
+        if not tasks:
+            return None
+
+        sized = [t for t in tasks if t.total]
+        if not sized:
+            after = abs(self._step % (2 * self.size - 2) - (self.size - 1))
+            before = (self.size - 1) - after
+            return "[%s➖%s] %s" % (" " * before, " " * after, tasks[0].message)
+
+        if len(tasks) == 1:
+            message = tasks[0].message
+        else:
+            message = "SCP: %d transfers" % len(tasks)
+        current = sum(t.current for t in sized)
+        total = sum(t.total for t in sized)
+        elapsed = time.monotonic() - min(t.started for t in sized)
+        text = "%s [%d%%]" % (message, 100 * current // total)
+        if current and elapsed > 1:
+            rate = current / elapsed
+            text += " %s/s, ETA %s" % (
+                format_size(rate),
+                format_time((total - current) / rate),
+            )
+        return text
+
+    def _update(self):
+        """Paint status bar text, if it changed."""
+        with self._lock:
+            self._scheduled = False
+            self._painted = time.monotonic()
+            busy = any(not t.total for t in self._tasks)
+        text = self.render()
+        if text is None and self._flash:
+            # keep final message of the last task
+            pass
+        elif text != self._text:
+            self._flash = None
+            self._text = text
+            self.paint(text)
+        if busy:
+            self._step += 1
+            self.notify()
+
+    def paint(self, message):
         """Paint the status bar text."""
+        window = sublime.active_window()
+        active_view = window.active_view() if window else None
 
-        if self.window is None:
-            self.window = sublime.active_window()
-        active_view = self.window.active_view()
+        if self._view is not None and active_view != self._view:
+            self._view.erase_status("_scp")
+            self._view = None
 
-        if self.last_view is not None and active_view != self.last_view:
-            self.last_view.erase_status("_scp")
-            self.last_view = None
+        if active_view is None:
+            return
 
         if message:
             active_view.set_status("_scp", message)
+            self._view = active_view
         else:
             active_view.erase_status("_scp")
+            self._view = None
+
+    def flash(self, message, timeout=2000):
+        """Paint a message for `timeout` milliseconds, if no task is active."""
+
+        def clear():
+            if self._flash == message:
+                self._flash = None
+                self.notify()
 
-        if self.last_view is None:
-            self.last_view = active_view
+        self._flash = self._text = message
+        self.paint(message)
+        sublime.set_timeout(clear, timeout)
+
+
+#: The status bar progress of all operations
+hub = ProgressHub()
+
+
+class Progress(object):
+
+    """
+    A busy indicator for operations of unknown size.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.task = None
+
+    def __enter__(self):
+        """Start progress bar."""
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Stop progress bar."""
+        if self.task:
+            self.task.finish()
+            self.task = None
+
+    def start(self):
+        self.task = hub.add(self.message)
+
+    def done(self, message):
+        """Stop and print finalization message."""
+        if self.task:
+            self.task.finish()
+            self.task = None
+        sublime.set_timeout(lambda: hub.flash(message))
@@ -0,0 +1,116 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class TokenBucket(object):
+
+    """
+    A token bucket to limit the average rate of transferred bytes.
+
+    Consuming more tokens than available is allowed, but the caller is
+    blocked until the debt would have been refilled at the configured rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Initialize the TokenBucket object.
+
+        Arguments:
+            rate (int):
+                The number of tokens (bytes) refilled per second.
+            burst (int):
+                The maximum number of tokens to store (default: `rate`).
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount, sleep=time.sleep):
+        """Take `amount` tokens and wait until the bucket isn't in debt.
+
+        :param sleep:
+            The function to wait with, which may raise to abort waiting.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            sleep(delay)
+
+
+class HostQoS(object):
+
+    """
+    Bandwidth and concurrency limits of a single connection.
+
+    Bulk transfers share `max_rate` reduced by `interactive_share`, which is
+    reserved for interactive transfers such as uploads on save. Interactive
+    transfers may use up to the full `max_rate` and don't wait for a free
+    transfer slot either, as they run in their own task queue lane.
+    A limit of 0 means unlimited.
+    """
+
+    def __init__(
+        self, max_rate=0, max_transfers=0, max_commands=0, interactive_share=0.25
+    ):
+        self.max_rate = max_rate
+        self._bulk = None
+        self._total = None
+        if max_rate:
+            reserved = max_rate * min(max(interactive_share, 0.0), 0.9)
+            self._bulk = TokenBucket(max_rate - reserved)
+            self._total = TokenBucket(max_rate)
+        self._transfers = threading.Semaphore(max_transfers) if max_transfers else None
+        self._commands = threading.Semaphore(max_commands) if max_commands else None
+        self._local = threading.local()
+
+    @contextmanager
+    def transfer(self, interactive=False):
+        """Run a transfer in a free slot.
+
+        Nested calls of the same thread share the slot of the outermost one.
+        """
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            interactive = self._local.interactive
+        slot = self._transfers if depth == 0 and not interactive else None
+        if slot:
+            slot.acquire()
+        self._local.depth = depth + 1
+        self._local.interactive = interactive
+        try:
+            yield self
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._local.interactive = False
+            if slot:
+                slot.release()
+
+    @contextmanager
+    def command(self):
+        """Run a remote command in a free slot."""
+        if self._commands:
+            self._commands.acquire()
+        try:
+            yield self
+        finally:
+            if self._commands:
+                self._commands.release()
+
+    def throttle(self, amount, sleep=time.sleep):
+        """Account `amount` transferred bytes and wait if the rate is exceeded.
+
+        :param sleep:
+            The function to wait with, such as a cancellable `SCPClient.sleep`.
+        """
+        if amount and self.max_rate:
+            if not getattr(self._local, "interactive", False):
+                self._bulk.consume(amount, sleep)
+            self._total.consume(amount, sleep)
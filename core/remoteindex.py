@@ -0,0 +1,215 @@
+import posixpath
+import threading
+import time
+
+from collections import namedtuple
+
+from .scpclient import SCPCommandError
+from .scpclient import SCPException
+
+#: A single entry of a remote directory listing
+DirEntry = namedtuple("DirEntry", ["name", "type", "size", "mtime"])
+
+#: Output format of `find -printf`: type, size, mtime, parent directory, name
+FIND_FORMAT = r"'%y\t%s\t%T@\t%h\t%f\n'"
+
+#: Output format of `stat -c`: raw mode in hex, size, mtime, path
+#: It is used if `find` doesn't support `-printf`, such as BusyBox's one.
+STAT_FORMAT = "'%f %s %Y %n'"
+
+#: File type bits of the raw mode mapped to the types of `FIND_FORMAT`
+STAT_TYPES = {0o040000: "d", 0o100000: "f", 0o120000: "l"}
+
+
+def parse_listing(text):
+    """Parse the output of a `find -printf FIND_FORMAT` call.
+
+    :param text:
+        The raw output of the remote `find` command.
+
+    :returns:
+        A dictionary of ``{directory: [DirEntry, ...]}``.
+    """
+    listing = {}
+    for line in text.splitlines():
+        try:
+            kind, size, mtime, parent, name = line.split("\t", 4)
+            entry = DirEntry(name, kind, int(size), float(mtime))
+        except ValueError:
+            continue
+        # find prints an empty parent for entries of /
+        listing.setdefault(posixpath.normpath(parent or "/"), []).append(entry)
+    return _sorted(listing)
+
+
+def parse_stat_listing(text):
+    """Parse the output of a `find -exec stat -c STAT_FORMAT` call.
+
+    :param text:
+        The raw output of the remote `find` command.
+
+    :returns:
+        A dictionary of ``{directory: [DirEntry, ...]}``.
+    """
+    listing = {}
+    for line in text.splitlines():
+        try:
+            mode, size, mtime, path = line.split(" ", 3)
+            kind = STAT_TYPES.get(int(mode, 16) & 0o170000, "?")
+            parent, name = posixpath.split(path)
+            entry = DirEntry(name, kind, int(size), float(mtime))
+        except ValueError:
+            continue
+        listing.setdefault(posixpath.normpath(parent or "/"), []).append(entry)
+    return _sorted(listing)
+
+
+def _sorted(listing):
+    """Sort entries of all directories, sub directories first."""
+    for entries in listing.values():
+        entries.sort(key=lambda e: (e.type != "d", e.name.lower()))
+    return listing
+
+
+class RemoteIndex(object):
+
+    """
+    A cache of structured remote directory listings.
+
+    Listings are cached per directory for `ttl` seconds. Whenever a directory
+    is listed, the listings of its sub directories are fetched in background
+    with a single remote `find` call, so browsing into them is instant.
+
+    GNU find's `-printf` is used to list directories. If the remote's `find`
+    doesn't support it, `stat` is called for all found entries instead.
+    """
+
+    #: Number of seconds a cached listing is considered valid
+    ttl = 30.0
+
+    def __init__(self, client, ttl=None):
+        self.client = client
+        if ttl is not None:
+            self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._prefetching = set()
+        self._printf = True
+
+    def listdir(self, remote, prefetch=True):
+        """Return the list of `DirEntry` objects of a remote directory.
+
+        :param remote:
+            The remote directory to list.
+        :param prefetch:
+            If ``True`` fetch the listings of all sub directories in background.
+        """
+        remote = self.normpath(remote)
+        entries = self.cached(remote)
+        if entries is None:
+            self._fetch(remote, 1, 1, [remote])
+            entries = self.cached(remote) or []
+        if prefetch:
+            self.prefetch(remote, entries)
+        return entries
+
+    def find(self, remote):
+        """Return all entries of the subtree `remote` as ``(path, DirEntry)`` tuples.
+
+        The whole subtree is read with a single `find` call and all its
+        directories are added to the cache.
+        """
+        remote = self.normpath(remote)
+        listing = self._fetch(remote, 1, None, [remote])
+        result = []
+        for parent, entries in listing.items():
+            for entry in entries:
+                path = posixpath.join(parent, entry.name)
+                result.append((posixpath.relpath(path, remote), entry))
+        result.sort(key=lambda item: item[0].lower())
+        return result
+
+    def cached(self, remote):
+        """Return the cached listing of `remote` or ``None`` if not valid."""
+        with self._lock:
+            item = self._cache.get(self.normpath(remote))
+        if item and time.time() - item[0] < self.ttl:
+            return item[1]
+        return None
+
+    def invalidate(self, remote=None):
+        """Drop the cached listing of `remote` or all listings if ``None``."""
+        with self._lock:
+            if remote is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(self.normpath(remote), None)
+
+    def prefetch(self, remote, entries):
+        """Fetch listings of all uncached sub directories in background."""
+        dirs = [
+            posixpath.join(remote, e.name)
+            for e in entries
+            if e.type == "d" and self.cached(posixpath.join(remote, e.name)) is None
+        ]
+        if not dirs:
+            return
+        with self._lock:
+            if remote in self._prefetching:
+                return
+            self._prefetching.add(remote)
+
+        def worker():
+            try:
+                self._fetch(remote, 2, 2, dirs)
+            except SCPException:
+                pass
+            finally:
+                with self._lock:
+                    self._prefetching.discard(remote)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _fetch(self, remote, mindepth, maxdepth, dirs):
+        """Run remote `find` and store the listings of all `dirs` in cache.
+
+        Requested directories without any entry are cached as empty listings.
+        Unreadable directories make `find` fail, but don't hide the others.
+        """
+        args = ["find", remote, "-mindepth", str(mindepth)]
+        if maxdepth is not None:
+            args += ["-maxdepth", str(maxdepth)]
+        listing = None
+        if self._printf:
+            try:
+                out = self.client.plink(
+                    " ".join(args + ["-printf", FIND_FORMAT]), partial=True
+                )
+                listing = parse_listing(out)
+            except SCPCommandError as err:
+                if "printf" not in str(err):
+                    raise
+                self._printf = False
+        if listing is None:
+            args += ["-exec", "stat", "-c", STAT_FORMAT, "{}", "+"]
+            out = self.client.plink(" ".join(args), partial=True)
+            listing = parse_stat_listing(out)
+        if maxdepth is None:
+            # the whole subtree was read, so empty sub directories are known
+            dirs = dirs + [
+                posixpath.join(parent, e.name)
+                for parent, entries in listing.items()
+                for e in entries
+                if e.type == "d"
+            ]
+        now = time.time()
+        with self._lock:
+            for path in dirs:
+                self._cache[path] = (now, listing.get(path, []))
+            for path, entries in listing.items():
+                self._cache[path] = (now, entries)
+        return listing
+
+    @staticmethod
+    def normpath(remote):
+        return posixpath.normpath(remote) if remote else "/"
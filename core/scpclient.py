@@ -1,7 +1,14 @@
 import os
 import re
+import shlex
+import signal
 import subprocess
 import sys
+import threading
+
+from contextlib import contextmanager
+
+from .qos import HostQoS
 
 
 class SCPException(Exception):
@@ -16,6 +23,10 @@ class SCPCommandError(SCPException):
     pass
 
 
+class SCPCancelledError(SCPCommandError):
+    pass
+
+
 class SCPClient(object):
     def __init__(self, host, port=22, user=None, passwd=None, hostkey=None, root=None):
         """Initialize an SCPClient object.
@@ -34,6 +45,12 @@ class SCPClient(object):
                 working directory and base for all relative path calulations.
         """
         self.proc = None  # active process
+        self._procs = set()  # all active processes
+        self._lock = threading.Lock()
+        self._operations = 0
+        self._cancelled = threading.Event()
+        self.journal = None  # journal of temporary files
+        self.qos = HostQoS()  # unlimited until configured
         self.root = root
         self.host = host
         self.port = port
@@ -74,25 +91,147 @@ class SCPClient(object):
     def scp_url(self, remote):
         return "%s@%s:%s" % (self.user, self.host, remote)
 
-    def exec(self, args):
+    def exec(
+        self,
+        args,
+        cancellable=True,
+        stdin=None,
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ):
+        """Start a process in its own process group.
+
+        :raises:
+            `SCPCancelledError` if the active operation was cancelled.
+        """
+        if cancellable:
+            self.check_cancelled()
         if sys.platform == "win32":
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
         else:
             startupinfo = None
-        return subprocess.Popen(
+            kwargs = {"start_new_session": True}
+        proc = subprocess.Popen(
             args=args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
             startupinfo=startupinfo,
-            universal_newlines=True,
+            universal_newlines=text,
+            **kwargs
         )
+        with self._lock:
+            self._procs.add(proc)
+        return proc
+
+    def _release(self, proc):
+        """Forget a finished process started by `exec()`."""
+        with self._lock:
+            self._procs.discard(proc)
+
+    @contextmanager
+    def operation(self):
+        """Run a cancellable operation.
+
+        The cancellation state is reset as soon as all operations are left.
+        """
+        with self._lock:
+            if not self._operations:
+                self._cancelled.clear()
+            self._operations += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._operations -= 1
+                if not self._operations:
+                    self._cancelled.clear()
+
+    def cancel(self):
+        """Cancel all active operations and terminate their processes."""
+        with self._lock:
+            if self._operations:
+                self._cancelled.set()
+            procs = list(self._procs)
+        for proc in procs:
+            try:
+                if sys.platform == "win32":
+                    proc.terminate()
+                else:
+                    os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def check_cancelled(self):
+        """Raise `SCPCancelledError` if the active operation was cancelled."""
+        if self._cancelled.is_set():
+            raise SCPCancelledError("SCP: operation cancelled!")
+
+    def sleep(self, seconds):
+        """Wait for `seconds` unless the active operation is cancelled.
+
+        :raises:
+            `SCPCancelledError` if the active operation was cancelled.
+        """
+        self._cancelled.wait(seconds)
+        self.check_cancelled()
+
+    @contextmanager
+    def temporary(self, remote=(), local=()):
+        """Record temporary files in the journal while they are in use."""
+        if self.journal is None:
+            yield
+        else:
+            with self.journal.track(remote, local):
+                yield
+
+    def free_space(self, remote="/tmp"):
+        """Return the number of bytes available at `remote` or None if unknown."""
+        try:
+            out = self.plink("df -Pk %s" % remote)
+            return int(out.splitlines()[-1].split()[3]) * 1024
+        except (IndexError, ValueError, SCPCommandError):
+            return None
+
+    def cleanup(self, *remote):
+        """Stop remote processes using and delete remote temporary files.
+
+        This also works after an operation was cancelled.
+        """
+        if not remote:
+            return
+        # A bracket expression is a regex for pkill and a glob pattern for rm,
+        # which keeps pkill from matching the command line of the shell.
+        # Files ending with other characters are deleted without pkill.
+        patterns, paths = [], []
+        for r in filter(None, remote):
+            if r[-1].isalnum():
+                patterns.append(shlex.quote("%s[%s]" % (r[:-1], r[-1])))
+                paths.append("%s[%s]" % (shlex.quote(r[:-1]), r[-1]))
+            else:
+                paths.append(shlex.quote(r))
+        command = "; ".join(
+            ["pkill -f %s" % p for p in patterns] + ["rm -rf %s" % " ".join(paths)]
+        )
+        proc = self.exec(self._plink + [command], cancellable=False)
+        try:
+            proc.communicate()
+        finally:
+            self._release(proc)
+        if self.journal is not None and not proc.returncode:
+            self.journal.forget(remote)
 
-    def plink(self, *args):
+    def plink(self, *args, partial=False):
         """Run remote shell command using plink.
 
         :param args:
             The command line to execute on the remote host.
+        :param partial:
+            If ``True`` a nonzero exit code is ignored as long as the command
+            printed anything to stdout, such as `find` with unreadable folders.
 
         :returns:
             The output of the command execution.
@@ -102,14 +241,90 @@ class SCPClient(object):
             `SCPCommandError` if plink returns nonzero exit code or
             stdout is empty but stderr contains error message.
         """
+        proc = None
         try:
-            self.proc = self.exec(self._plink + list(args))
-            out, err = self.proc.communicate()
-            if self.proc.returncode or err and not out:
+            with self.qos.command():
+                self.proc = proc = self.exec(self._plink + list(args))
+                out, err = proc.communicate()
+            self.check_cancelled()
+            if (proc.returncode and not (partial and out)) or err and not out:
                 raise SCPCommandError(err)
             return out
         finally:
             self.proc = None
+            if proc:
+                self._release(proc)
+
+    def stream(self, command, write=False, feed=None):
+        """Start a remote shell command with a binary pipe.
+
+        Error output is collected in a temporary file, so a chatty command
+        can't block on a full pipe nobody reads.
+
+        :param command:
+            The command line to execute on the remote host.
+        :param write:
+            If ``True`` the command's stdin is connected to a pipe and its
+            stdout is discarded, otherwise stdout is connected to a pipe.
+        :param feed:
+            Optional bytes to write to the stdin of a reading command, which
+            is done by a background thread to not block reading stdout.
+
+        :returns:
+            The `Popen` object of the plink process, which must be passed to
+            `close()` when done.
+        """
+        import tempfile
+
+        errors = tempfile.TemporaryFile()
+        try:
+            proc = self.exec(
+                self._plink + [command],
+                stdin=subprocess.PIPE if write or feed is not None else None,
+                text=False,
+                stdout=subprocess.DEVNULL if write else subprocess.PIPE,
+                stderr=errors,
+            )
+        except BaseException:
+            errors.close()
+            raise
+        proc.errors = errors
+
+        if feed is not None and not write:
+
+            def writer():
+                try:
+                    proc.stdin.write(feed)
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+            threading.Thread(target=writer, daemon=True).start()
+
+        return proc
+
+    def finish(self, proc):
+        """Wait for a process started by `stream()` to exit.
+
+        :raises:
+            `SCPCancelledError` if the active operation was cancelled.
+            `SCPCommandError` if the process returned nonzero exit code.
+        """
+        proc.wait()
+        self.check_cancelled()
+        if proc.returncode:
+            proc.errors.seek(0)
+            raise SCPCommandError(proc.errors.read().decode(errors="replace"))
+
+    def close(self, proc):
+        """Terminate a process started by `stream()`, if still running."""
+        try:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        finally:
+            proc.errors.close()
+            self._release(proc)
 
     def pscp(self, *args, on_progress=None):
         """Run a pscp command.
@@ -121,13 +336,28 @@ class SCPClient(object):
             `CalledProcessError` if an error occured with executing plink.
             `SCPCommandError` if pscp returns nonzero exit code.
         """
+        with self.qos.transfer():
+            # pscp can't be throttled, so wait for the bandwidth it is going to
+            # use before uploading and for the used one after downloading.
+            download = args[0].startswith(self.scp_url(""))
+            if not download:
+                self.qos.throttle(
+                    sum(os.path.getsize(a) for a in args[:-1] if os.path.isfile(a)),
+                    self.sleep,
+                )
+            self._pscp_run(args, on_progress)
+            if download and os.path.isfile(args[-1]):
+                self.qos.throttle(os.path.getsize(args[-1]), self.sleep)
+
+    def _pscp_run(self, args, on_progress):
+        proc = None
         try:
-            self.proc = self.exec(self._pscp + list(args))
+            self.proc = proc = self.exec(self._pscp + list(args))
             if callable(on_progress):
                 while True:
-                    data = self.proc.stdout.readline(2 ** 16)
+                    data = proc.stdout.readline(2 ** 16)
                     if not bool(data):
-                        return
+                        break
 
                     # Parse scp's output to get current file name being transfered.
                     # cp1250.py   | 4 kB |   4.0 kB/s | ETA: 00:00:02 |  29%
@@ -138,16 +368,18 @@ class SCPClient(object):
                     else:
                         on_progress(file, percent)
 
-            self.proc.wait()
-            if self.proc.returncode:
-                raise SCPCommandError(self.proc.stderr.read())
+            proc.wait()
+            self.check_cancelled()
+            if proc.returncode:
+                raise SCPCommandError(proc.stderr.read())
 
         finally:
             self.proc = None
+            if proc:
+                self._release(proc)
 
     def abort(self):
-        if self.proc:
-            self.proc.terminate()
+        self.cancel()
 
     def rename(self, remote, remote_new):
         return self.plink(
@@ -164,6 +396,32 @@ class SCPClient(object):
             return self.plink("mkdir -p %s" % remote)
         return self.plink(";".join(["mkdir -p %s" % r for r in remote]))
 
+    def stat(self, remote):
+        """Return size and modification time of one or more remote files.
+
+        All files are queried with a single `stat` call.
+
+        :param remote:
+            A remote path or a list of remote paths.
+
+        :returns:
+            A dictionary of ``{path: (size, mtime)}``. Missing files are omitted.
+        """
+        if isinstance(remote, str):
+            remote = [remote]
+        # stat fails if any file is missing, but still prints all the others
+        out = self.plink(
+            "stat -c '%s %Y %n' {} 2>/dev/null; true".format(" ".join(remote))
+        )
+        result = {}
+        for line in out.splitlines():
+            try:
+                size, mtime, name = line.split(" ", 2)
+                result[name] = (int(size), int(mtime))
+            except ValueError:
+                pass
+        return result
+
     def lsdir(self, remote):
         return self.pscp("-ls", self.scp_url(remote))
 
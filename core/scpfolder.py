@@ -1,12 +1,17 @@
 import os
+import posixpath
 import re
 import sys
+import time
 
 from fnmatch import fnmatch
 
 import sublime
 
+from .qos import HostQoS
+from .scpclient import SCPCancelledError
 from .scpclient import SCPClient
+from .scpclient import SCPCommandError
 from .scpclient import SCPException
 from .scpclient import SCPNotConnectedError
 
@@ -19,7 +24,7 @@ class SCPFolderError(SCPException):
 
 def connect(path):
     try:
-        return connection(path)
+        return connection(path, reload=False)
     except SCPNotConnectedError:
         try:
             if sys.platform == "win32":
@@ -27,6 +32,9 @@ def connect(path):
             else:
                 client = SCPFolder(path)
             connections.append(client)
+            # remove temporary files left behind by failed or crashed transfers
+            sublime.set_timeout_async(lambda: client.journal.sweep(client))
+            _schedule_sweep()
             return client
         except SCPException:
 
@@ -36,20 +44,54 @@ def connect(path):
 def disconnect(path):
     try:
         while True:
-            connections.remove(connection(path))
+            connections.remove(connection(path, reload=False))
     except (IndexError, SCPException):
         pass
 
 
-def connection(path):
+def connection(path, reload=True):
+    """Return the connection of a path.
+
+    If `reload` is ``True`` changes of the connection's .scp file are applied.
+    The connection is reestablished if host or credentials changed.
+    """
     if path:
         p = path.lower() if sys.platform == "win32" else path
         for client in connections:
             if p.startswith(client.root):
+                if reload and not client.reload():
+                    print("SCP: settings of %s changed, reconnecting..." % client.root)
+                    connections.remove(client)
+                    client = connect(client.root)
+                    if not client:
+                        break
                 return client
     raise SCPNotConnectedError("No SCP connection for %s!" % path)
 
 
+#: Seconds between two sweeps of temporary files of all connections
+sweep_interval = 300
+
+_sweep_scheduled = False
+
+
+def _schedule_sweep():
+    global _sweep_scheduled
+    if not _sweep_scheduled:
+        _sweep_scheduled = True
+        sublime.set_timeout_async(_sweep, sweep_interval * 1000)
+
+
+def _sweep():
+    """Periodically remove temporary files left behind by failed transfers."""
+    global _sweep_scheduled
+    _sweep_scheduled = False
+    for client in list(connections):
+        client.journal.sweep(client)
+    if connections:
+        _schedule_sweep()
+
+
 def is_connected(path):
     if path:
         p = path.lower() if sys.platform == "win32" else path
@@ -59,39 +101,149 @@ def is_connected(path):
     return False
 
 
+#: Seconds to cache results of `root_dir()`
+root_dir_ttl = 2.0
+
+_root_dirs = {}
+
+
 def root_dir(file_name):
+    """Return the mapped folder containing `file_name` or False.
+
+    Results are cached for a short time as menu visibility checks call this
+    function very often, while a mapping is rarely created.
+    """
     if file_name:
-        path, name = file_name, "."
-        while path and name and name != ".scp":
-            if path and os.path.exists(os.path.join(path, ".scp")):
-                return path
-            path, name = os.path.split(path)
+        now = time.monotonic()
+        try:
+            stamp, result = _root_dirs[file_name]
+            if now - stamp < root_dir_ttl:
+                return result
+        except KeyError:
+            if len(_root_dirs) > 1000:
+                _root_dirs.clear()
+        result = _root_dir(file_name)
+        _root_dirs[file_name] = (now, result)
+        return result
+    return False
+
+
+def _root_dir(file_name):
+    path, name = file_name, "."
+    while path and name and name != ".scp":
+        if path and os.path.exists(os.path.join(path, ".scp")):
+            return path
+        path, name = os.path.split(path)
     return False
 
 
 class SCPFolder(SCPClient):
+    #: Maximum number of cached results of `to_remote_path()`
+    max_cached_paths = 100000
+
     def __init__(self, path):
         root = root_dir(path)
         if not root:
             raise SCPFolderError("Not within a mapped folder")
-        with open(os.path.join(root, ".scp")) as file:
-            client = sublime.decode_value(file.read())
-            SCPClient.__init__(
-                self,
-                client["host"],
-                client.get("port", 22),
-                client.get("user", "guest"),
-                client.get("passwd", None),
-                client.get("hostkey", None),
-                root,
-            )
-            self.remote_dir = client.get("dir", "/")
-            self.files_pattern = client.get("files", [])
-            self.dirs_mapping = client.get("dirmap", {})
-            self.path_map = client.get("mappings", [])
-            self.debug = client.get("debug", False)
+        self.config_file = os.path.join(root, ".scp")
+        self.config_mtime = os.path.getmtime(self.config_file)
+        client = self.load_config(self.config_file)
+        SCPClient.__init__(
+            self,
+            client["host"],
+            client.get("port", 22),
+            client.get("user", "guest"),
+            client.get("passwd", None),
+            client.get("hostkey", None),
+            root,
+        )
+        from . import journal
+        from .remoteindex import RemoteIndex
+
+        self.credentials = self.get_credentials(client)
+        self.index = RemoteIndex(self)
+        self.journal = journal.journal(self)
+        self.configure(client)
+
+    @staticmethod
+    def load_config(file_name):
+        with open(file_name) as file:
+            return sublime.decode_value(file.read())
+
+    @staticmethod
+    def get_credentials(client):
+        """Return all settings, which require to reconnect if changed."""
+        return tuple(
+            client.get(key) for key in ("host", "port", "user", "passwd", "hostkey")
+        )
+
+    def configure(self, client):
+        """Apply all settings, which don't require to reconnect."""
+        # transfer helpers are imported on first connect, not on plugin load
+        from . import chunked
+        from . import delta
+
+        self.remote_dir = client.get("dir", "/")
+        self.files_pattern = client.get("files", [])
+        self.dirs_mapping = client.get("dirmap", {})
+        self.path_map = client.get("mappings", [])
+        self.debug = client.get("debug", False)
+        self.index.ttl = client.get("index_ttl", type(self.index).ttl)
+        self.delta_threshold = client.get("delta_threshold", 16 * 2 ** 20)
+        self.delta_block_size = client.get("delta_block_size", delta.BLOCK_SIZE)
+        self.chunk_threshold = client.get("chunk_threshold", 64 * 2 ** 20)
+        self.chunk_size = client.get("chunk_size", chunked.CHUNK_SIZE)
+        self.retries = client.get("retries", chunked.RETRIES)
+        qos = (
+            client.get("max_rate", 0),
+            client.get("max_transfers", 0),
+            client.get("max_commands", 0),
+            client.get("interactive_share", 0.25),
+        )
+        # keep slots of running transfers, unless limits changed
+        if qos != getattr(self, "_qos", None):
+            self._qos = qos
+            self.qos = HostQoS(*qos)
+        # compiled dirmap and cached results of `to_remote_path()`
+        self._dirmap = [
+            (re.compile(source), target) for source, target in self.dirs_mapping.items()
+        ]
+        self._remote_paths = {}
+
+    def reload(self):
+        """Apply changes of the .scp file to the live connection.
+
+        :returns:
+            ``False`` if connection settings changed and a reconnect is required.
+        """
+        try:
+            mtime = os.path.getmtime(self.config_file)
+            if mtime == self.config_mtime:
+                return True
+            client = self.load_config(self.config_file)
+        except (OSError, ValueError, KeyError):
+            return True
+        self.config_mtime = mtime
+        if self.get_credentials(client) != self.credentials:
+            return False
+        self.configure(client)
+        if self.debug:
+            print("SCP: reloaded", self.config_file)
+        return True
 
     def to_remote_path(self, path):
+        key = (path, os.path.isfile(path))
+        if key in self._remote_paths:
+            result = self._remote_paths[key]
+        else:
+            if len(self._remote_paths) >= self.max_cached_paths:
+                self._remote_paths.clear()
+            result = self._remote_paths[key] = self._to_remote_path(*key)
+        if result is None:
+            raise ValueError("Not a handled file!")
+        return result
+
+    def _to_remote_path(self, path, is_file):
         rel_path = self.relpath(path)
         if rel_path.startswith(".."):
             raise ValueError("Invalid path!")
@@ -101,15 +253,15 @@ class SCPFolder(SCPClient):
 
         rel_path = rel_path.replace("\\", "/")
 
-        if os.path.isfile(path):
+        if is_file:
             if not any(fnmatch(rel_path, p) for p in self.files_pattern):
-                raise ValueError("Not a handled file!")
+                return None
             dirname, filename = os.path.split(rel_path)
         else:
             dirname, filename = rel_path, ""
-        for source, target in self.dirs_mapping.items():
-            if re.match(source, dirname):
-                result = re.sub(source, target, rel_path)
+        for source, target in self._dirmap:
+            if source.match(dirname):
+                result = source.sub(target, rel_path)
                 result = os.path.normpath(os.path.join(self.remote_dir, result, filename))
                 result = result.replace("\\", "/")
                 if self.debug:
@@ -133,9 +285,11 @@ class SCPFolder(SCPClient):
         return not self.relpath(path).startswith("..")
 
     def rename(self, path, newpath):
+        self.index.invalidate()
         return super().rename(self.to_remote_path(path), self.to_remote_path(newpath))
 
     def remove(self, path):
+        self.index.invalidate()
         return super().remove(self.to_remote_path(path))
 
     def mkdir(self, path):
@@ -144,8 +298,84 @@ class SCPFolder(SCPClient):
     def lsdir(self, path):
         return super().lsdir(self.to_remote_path(path))
 
-    def putfile(self, path):
-        return super().putfile(path, self.to_remote_path(path))
+    def putfile(self, path, on_progress=None):
+        from . import delta
+
+        remote = self.to_remote_path(path)
+        self.index.invalidate(os.path.dirname(remote))
+        if self.delta_threshold and os.path.getsize(path) >= self.delta_threshold:
+            # send changed blocks only, if remote file exists
+            try:
+                if delta.putfile(
+                    self, path, remote, self.delta_block_size, on_progress
+                ):
+                    return
+            except SCPCancelledError:
+                raise
+            except SCPCommandError as err:
+                print("SCP: delta upload failed,", str(err).strip())
+        return self.upload(path, remote, on_progress)
+
+    def getfile(self, path, on_progress=None, size=None):
+        return self.download(self.to_remote_path(path), path, on_progress, size)
+
+    def upload(self, local, remote, on_progress=None):
+        """Upload a local file to an untranslated remote path.
+
+        Files above `chunk_threshold` are sent in resumable, verified chunks.
+        """
+        from . import chunked
+
+        if self._use_chunks(os.path.getsize(local)):
+            return chunked.putfile(
+                self,
+                local,
+                remote,
+                self.chunk_size,
+                self.retries,
+                on_progress=on_progress,
+            )
+        return super().putfile(local, remote, on_progress)
+
+    def download(self, remote, local, on_progress=None, size=None):
+        """Download an untranslated remote path to a local file.
+
+        Files above `chunk_threshold` are fetched in resumable, verified chunks.
+        The remote file's `size` is looked up, if not given and chunks may apply.
+        """
+        from . import chunked
 
-    def getfile(self, path):
-        return super().getfile(self.to_remote_path(path), path)
+        if size is None and (self.chunk_threshold or self.qos.max_rate):
+            size = self.remote_size(remote)
+        if size and self._use_chunks(size):
+            return chunked.getfile(
+                self,
+                remote,
+                local,
+                self.chunk_size,
+                self.retries,
+                on_progress=on_progress,
+            )
+        return super().getfile(remote, local, on_progress)
+
+    def remote_size(self, remote):
+        """Return the size of an untranslated remote file.
+
+        The size is taken from the index's cached listings, if possible,
+        to save a remote `stat` call.
+        """
+        name = posixpath.basename(remote)
+        for entry in self.index.cached(posixpath.dirname(remote)) or ():
+            if entry.name == name:
+                return entry.size
+        return self.stat(remote).get(remote, (0, 0))[0]
+
+    def _use_chunks(self, size):
+        """Return True if a file of `size` bytes is to be transferred in chunks.
+
+        Chunks are also used with a bandwidth limit, as pscp can be throttled
+        between chunks only.
+        """
+        if self.qos.max_rate and size >= 2 * self.chunk_size:
+            return True
+        return bool(self.chunk_threshold) and size >= self.chunk_threshold
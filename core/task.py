@@ -1,6 +1,5 @@
 import traceback
 
-from queue import Empty
 from queue import Queue
 from threading import Thread
 
@@ -11,10 +10,16 @@ class Task(object):
     Task runs a python function `target` when called.
     """
 
-    def __init__(self, target, *args):
-        """Initialize the Task object."""
+    def __init__(self, target, *args, owners=()):
+        """Initialize the Task object.
+
+        :param owners:
+            The connections the task operates on. Used to cancel all tasks
+            of a connection.
+        """
         self.target = target
         self.args = args
+        self.owners = set(owners)
 
     def run(self):
         self.target(*self.args)
@@ -39,13 +44,28 @@ class TaskQueue(Thread):
     def call(self, task):
         self.queue.put(task)
 
+    def cancel(self, owner=None):
+        """Drop all queued tasks of `owner` or all queued tasks if ``None``.
+
+        :returns:
+            The active task, if it belongs to `owner`.
+        """
+        with self._block:
+            queue = self.queue.queue
+            keep = [t for t in queue if owner is not None and owner not in t.owners]
+            dropped = len(queue) - len(keep)
+            queue.clear()
+            queue.extend(keep)
+            self.queue.unfinished_tasks -= dropped
+            if not self.queue.unfinished_tasks:
+                self.queue.all_tasks_done.notify_all()
+            active = self.active_task
+        if active and (owner is None or owner in active.owners):
+            return active
+        return None
+
     def cancel_all(self):
-        try:
-            while not self.Empty():
-                self.queue.get_nowait()
-                self.queue.task_done()
-        except Empty:
-            pass
+        self.cancel()
 
     def busy(self):
         result = False
@@ -69,25 +89,44 @@ class TaskQueue(Thread):
                     self.active_task = None
 
 
-## [ default task queue ] ####################################################
+## [ default task queues ] ###################################################
 
 
-_tasks = TaskQueue()
-_tasks.start()
+#: The lane of interactive tasks, such as uploads on save, which must not wait
+#: for bulk transfers queued in the default lane.
+INTERACTIVE = "interactive"
+
+# The queues' threads are started on first use, not on plugin load.
+_lanes = {}
+
+
+def _queue(lane=None):
+    """Return the task queue of `lane`, the default one if ``None``."""
+    if lane not in _lanes:
+        queue = _lanes[lane] = TaskQueue()
+        queue.start()
+    return _lanes[lane]
 
 
 def busy():
-    return _tasks.busy()
+    return any(queue.busy() for queue in list(_lanes.values()))
 
 
-def call_task(task):
-    _tasks.call(task)
+def call_task(task, lane=None):
+    _queue(lane).call(task)
     return task
 
 
-def call_func(func, *args):
-    return call_task(Task(func, *args))
+def call_func(func, *args, owners=(), lane=None):
+    return call_task(Task(func, *args, owners=owners), lane)
+
+
+def cancel(owner):
+    """Drop queued tasks of `owner` in all lanes and return an active one."""
+    active = [queue.cancel(owner) for queue in list(_lanes.values())]
+    return next((task for task in active if task), None)
 
 
 def cancel_all():
-    _tasks.cancel_all()
+    for queue in list(_lanes.values()):
+        queue.cancel_all()
@@ -0,0 +1,42 @@
+import functools
+import threading
+import time
+
+_lock = threading.Lock()
+
+#: Accumulated timings as ``{name: [count, total seconds, max seconds]}``
+timings = {}
+
+
+def record(name, seconds):
+    """Add a single measurement to the timings of `name`."""
+    with _lock:
+        item = timings.setdefault(name, [0, 0.0, 0.0])
+        item[0] += 1
+        item[1] += seconds
+        item[2] = max(item[2], seconds)
+
+
+def timed(func):
+    """Decorator to record the execution time of each call of `func`."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(func.__qualname__, time.perf_counter() - start)
+
+    return wrapper
+
+
+def report():
+    """Return the recorded timings as printable text."""
+    lines = ["%-40s %8s %10s %10s" % ("SCP timings", "calls", "total ms", "max ms")]
+    with _lock:
+        for name, (count, total, peak) in sorted(timings.items()):
+            lines.append(
+                "%-40s %8d %10.2f %10.2f" % (name, count, total * 1000, peak * 1000)
+            )
+    return "\n".join(lines)